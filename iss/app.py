@@ -363,7 +363,8 @@ def model_from_bam(args):
         sys.exit(1)
     else:
         logger.info('Using KDE ErrorModel')
-        bam.to_model(args.bam, args.output)
+        logger.info('Using %s cpus for modelling' % args.cpus)
+        bam.to_model(args.bam, args.output, args.cpus)
         logger.info('Model generation complete')
 
 
@@ -575,6 +576,14 @@ def main():
         default=False,
         help='Enable debug logging. (default: %(default)s).'
     )
+    parser_mod.add_argument(
+        '--cpus',
+        '-p',
+        default=2,
+        type=int,
+        metavar='<int>',
+        help='number of cpus to use. (default: %(default)s).'
+    )
     parser_mod.add_argument(
         '--bam',
         '-b',
@@ -6,18 +6,40 @@ from iss import modeller
 
 from scipy import stats
 from random import random
+from joblib import Parallel, delayed, effective_n_jobs
+from queue import Queue
+from collections import Counter
 
+import os
 import sys
 import pysam
+import threading
 import logging
 import numpy as np
 
+# default number of reads subsampled from a bam file for modelling
+N_READS = 1000000
 
-def read_bam(bam_file, n_reads=1000000):
+
+def read_bam(bam_file, n_reads=N_READS, regions=None, threads=1,
+             random_fraction=None):
     """Bam file reader. Select random mapped reads from a bam file
 
     Args:
         bam_file (string): path to a bam file
+        n_reads (int): number of reads to subsample from the whole bam file.
+            The reads are selected with a probability of n_reads / number of
+            mapped reads, and at most n_reads are yielded by a single call.
+            When the file is read in several parts, the same random_fraction
+            should be given to each call, and about n_reads reads are selected
+            in total
+        regions (list): a list of (contig, start, stop) regions of the bam
+            file. If set, only the reads starting in these regions are read
+        threads (int): number of threads used by htslib to decompress the
+            bam file
+        random_fraction (float): probability of selecting a read. Computed
+            from n_reads and the number of mapped reads of the bam file by
+            default
 
     Yields:
         read: a pysam read object
@@ -25,32 +47,155 @@ def read_bam(bam_file, n_reads=1000000):
     logger = logging.getLogger(__name__)
 
     try:
-        lines = pysam.idxstats(bam_file).splitlines()
-        total_records = sum([int(l.split("\t")[2])
-                            for l in lines if not l.startswith("#")])
-        # total_records = sum(1 for _ in bam.fetch() if not _.is_unmapped)
-        random_fraction = n_reads / total_records
-        bam = pysam.AlignmentFile(bam_file, 'rb')  # reopen the file
+        if random_fraction is None:
+            random_fraction = n_reads / count_mapped_reads(bam_file)
+        bam = pysam.AlignmentFile(bam_file, 'rb', threads=threads)
 
     except (IOError, ValueError,
             ZeroDivisionError, pysam.utils.SamtoolsError) as e:
         logger.error('Failed to read bam file: %s' % e)
         sys.exit(1)
     else:
-        logger.info('Reading bam file: %s' % bam_file)
-        c = 0
+        if regions is None:
+            logger.info('Reading bam file: %s' % bam_file)
+        else:
+            logger.debug('Reading %s regions of bam file: %s' % (
+                len(regions), bam_file))
+        # the reads are fetched by a background thread so that decoding the
+        # bam file overlaps with the processing of the reads we yield
+        batches = Queue(maxsize=4)
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=fetch_reads,
+            args=(bam, regions, random_fraction, n_reads, batches, stop),
+            daemon=True)
+        reader.start()
+        batch = []
+        try:
+            while batch is not None:
+                batch = batches.get()
+                if isinstance(batch, Exception):
+                    raise batch
+                elif batch is not None:
+                    yield from batch
+        finally:
+            stop.set()
+            while batch is not None:  # unblock the reader if it is waiting
+                batch = batches.get()
+            reader.join()
+
+
+def count_mapped_reads(bam_file):
+    """Count the mapped reads of a bam file from its index
+
+    Args:
+        bam_file (string): path to an indexed bam file
+
+    Returns:
+        int: the number of mapped reads
+    """
+    lines = pysam.idxstats(bam_file).splitlines()
+    return sum([int(l.split("\t")[2])
+                for l in lines if not l.startswith("#")])
+
+
+def fetch_reads(bam, regions, random_fraction, n_reads, batches, stop,
+                batch_size=1024):
+    """Select random mapped reads from a bam file and put them in a queue
+
+    The reads are put in the queue in batches (lists of reads). An exception
+    is put in the queue if one occurs, and None once all the reads are read
+
+    Args:
+        bam (AlignmentFile): an opened bam file. Closed by the function
+        regions (list): a list of (contig, start, stop) regions of the bam
+            file, or None to read the whole file
+        random_fraction (float): probability of selecting a read
+        n_reads (int): maximum number of reads to select
+        batches (Queue): the queue to put the batches of reads in
+        stop (Event): stop reading the bam file when set
+        batch_size (int): number of reads per batch
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
         with bam:
-            for read in bam.fetch():
-                if not read.is_unmapped and random() < random_fraction:
-                    c += 1
-                    if logger.getEffectiveLevel() == 10:
-                        print(
-                            'DEBUG:iss.bam:Subsampling %s / %s reads' % (
-                                c, n_reads),
-                            end='\r')
-                    yield read
-                elif c >= n_reads:
+            batch = []
+            c = 0
+            for region in regions or [None]:
+                reads = bam.fetch() if region is None else bam.fetch(*region)
+                for read in reads:
+                    if stop.is_set():
+                        return
+                    # reads overlapping the start of the region belong to the
+                    # previous region
+                    if region is not None and read.reference_start < region[1]:
+                        continue
+                    if not read.is_unmapped and random() < random_fraction:
+                        c += 1
+                        if logger.getEffectiveLevel() == 10:
+                            print(
+                                'DEBUG:iss.bam:Subsampling %s / %s reads' % (
+                                    c, n_reads),
+                                end='\r')
+                        batch.append(read)
+                        if len(batch) == batch_size:
+                            batches.put(batch)
+                            batch = []
+                    elif c >= n_reads:
+                        break
+                if c >= n_reads:
                     break
+            batches.put(batch)
+    except Exception as e:
+        batches.put(e)
+    finally:
+        batches.put(None)
+
+
+def split_bam(bam_file, n_parts=1):
+    """Split the reference sequences of a bam file in parts of similar size
+
+    Each part is a list of regions. Long reference sequences are cut in
+    several regions while short ones are grouped in the same part, so that
+    the number of parts does not depend on the number of reference sequences
+
+    Args:
+        bam_file (string): path to a bam file
+        n_parts (int): the approximate number of parts to create
+
+    Returns:
+        list: a list of parts, each a list of (contig, start, stop) tuples.
+            The parts cover all the reference sequences
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        with pysam.AlignmentFile(bam_file, 'rb') as bam:
+            references = list(zip(bam.references, bam.lengths))
+    except (IOError, ValueError) as e:
+        logger.error('Failed to read bam file: %s' % e)
+        sys.exit(1)
+
+    total_length = sum(length for _, length in references)
+    part_size = max(1, -(-total_length // n_parts))  # ceiling division
+    parts = []
+    part = []
+    part_length = 0
+    for contig, length in references:
+        start = 0
+        while start < length:
+            stop = min(start + part_size - part_length, length)
+            part.append((contig, start, stop))
+            part_length += stop - start
+            start = stop
+            if part_length == part_size:
+                parts.append(part)
+                part = []
+                part_length = 0
+    if part:
+        parts.append(part)
+    return parts
 
 
 def write_to_file(model, read_length, mean_f, mean_r, hist_f, hist_r,
@@ -106,83 +251,124 @@ def write_to_file(model, read_length, mean_f, mean_r, hist_f, hist_r,
         sys.exit(1)
 
 
-def to_model(bam_path, output):
-    """from a bam file, write all variables needed for modelling reads in
-    a .npz model file
+def analyze_bam(bam_path, regions=None, threads=1, random_fraction=None):
+    """Gather the raw data needed for modelling reads from a bam file
 
-    For a brief description of the variables that will be written to the
-        output file, see the bam.write_to_file function
+    The insert sizes, qualities, substitutions and indels are all extracted
+    in a single pass over the (subsampled) reads of the bam file
 
     Args:
         bam_path (string): path to a bam file
-        output (string): prefix of the output file
+        regions (list): a list of (contig, start, stop) regions of the bam
+            file to analyze. Analyze the whole file by default
+        threads (int): number of threads used by htslib to decompress the
+            bam file
+        random_fraction (float): probability of selecting a read. See
+            read_bam
+
+    Returns:
+        tuple: the count of each insert size, the qualities of the forward and
+        reverse reads, the substitution matrices and the indel matrices of
+        the forward and reverse reads
     """
-    logger = logging.getLogger(__name__)
-
-    insert_size_dist = []
+    insert_size_dist = Counter()
     qualities_forward = []
     qualities_reverse = []
-    subst_matrix_f = np.zeros([301, 16])  # we dont know the len of the reads
-    subst_matrix_r = np.zeros([301, 16])  # yet. we will find out from the
-    indel_matrix_f = np.zeros([301, 9])   # len of the quality lists
-    indel_matrix_r = np.zeros([301, 9])
-
-    # read the bam file and extract info needed for modelling
-    for read in read_bam(bam_path):
+    # we dont know the len of the reads yet. we will find out from the len of
+    # the quality lists
+    subst_matrix_f = np.zeros([301, 4, 4], dtype=np.int32)
+    subst_matrix_r = np.zeros([301, 4, 4], dtype=np.int32)
+    indel_matrix_f = np.zeros([301, 4, 2], dtype=np.int32)
+    indel_matrix_r = np.zeros([301, 4, 2], dtype=np.int32)
+
+    for read in read_bam(bam_path, regions=regions, threads=threads,
+                         random_fraction=random_fraction):
         # get insert size distribution
         if read.is_proper_pair:
             template_length = abs(read.template_length)
-            i_size = template_length - (2 * len(read.seq))
-            insert_size_dist.append(i_size)
-
-        # get qualities
-        if read.is_read1:
-            # get mean quality too
-            quality_means = []
-            read_quality = read.query_qualities
-            mean_quality = np.mean(read_quality)
-            if read.is_reverse:
-                read_quality = read_quality[::-1]  # reverse the list
+            i_size = template_length - (2 * read.query_length)
+            insert_size_dist[i_size] += 1
 
-            quality_plus_mean = [
-                (quality, mean_quality) for quality in read_quality]
-            qualities_forward.append(np.asarray(quality_plus_mean))
-            # qualities_forward.append(read.query_qualities)
-        elif read.is_read2:
-            # get mean quality too
-            quality_means = []
-            read_quality = read.query_qualities
+        # get qualities and mean quality
+        if read.is_read1 or read.is_read2:
+            read_quality = np.frombuffer(read.query_qualities, np.uint8)
             mean_quality = np.mean(read_quality)
             if read.is_reverse:
-                read_quality = read_quality[::-1]  # reverse the list
-
-            quality_plus_mean = [
-                (quality, mean_quality) for quality in read_quality]
-            qualities_reverse.append(np.asarray(quality_plus_mean))
-            # qualities_reverse.append(read.query_qualities)
+                read_quality = read_quality[::-1]  # reverse the array
+            if read.is_read1:
+                qualities_forward.append((read_quality, mean_quality))
+            else:
+                qualities_reverse.append((read_quality, mean_quality))
 
         # get mismatches
-        alignment = read.get_aligned_pairs(
-            matches_only=True,
-            with_seq=True
-            )
-        read_has_indels = False
-        for base in alignment:  # dispatch mismatches in matrix
-            pos, subst, read_has_indels = modeller.dispatch_subst(
-                base, read, read_has_indels)
-            if read.is_read1 and subst is not None:
-                subst_matrix_f[pos, subst] += 1
-            elif read.is_read2 and subst is not None:
-                subst_matrix_r[pos, subst] += 1
+        pos, subst, read_has_indels = modeller.dispatch_read_subst(read)
+        if read.is_read1:  # dispatch mismatches in matrix
+            np.add.at(subst_matrix_f, (pos,) + subst, 1)
+        elif read.is_read2:
+            np.add.at(subst_matrix_r, (pos,) + subst, 1)
         if read_has_indels:  # dispatch indels in matrix
             for pos, indel in modeller.dispatch_indels(read):
                 if read.is_read1:
-                    indel_matrix_f[pos, indel] += 1
+                    indel_matrix_f[pos][indel] += 1
                 elif read.is_read2:
-                    indel_matrix_r[pos, indel] += 1
+                    indel_matrix_r[pos][indel] += 1
+
+    return (insert_size_dist, qualities_forward, qualities_reverse,
+            subst_matrix_f, subst_matrix_r, indel_matrix_f, indel_matrix_r)
+
+
+def to_model(bam_path, output, cpus=1):
+    """from a bam file, write all variables needed for modelling reads in
+    a .npz model file
+
+    For a brief description of the variables that will be written to the
+        output file, see the bam.write_to_file function
+
+    Args:
+        bam_path (string): path to a bam file
+        output (string): prefix of the output file
+        cpus (int): number of cpus to use for reading the bam file. As for
+            joblib, negative values count down from all the cpus (-1 uses
+            all of them)
+    """
+    logger = logging.getLogger(__name__)
+
+    try:
+        cpus = effective_n_jobs(cpus)
+    except ValueError as e:
+        logger.error('Invalid number of cpus: %s' % e)
+        sys.exit(1)
+
+    # read the bam file and extract info needed for modelling. The bam file is
+    # split in parts analyzed in parallel, and the results are merged
+    logger.info('Reading bam file: %s' % bam_path)
+    try:
+        # subsample N_READS reads from the whole file rather than from
+        # each part
+        random_fraction = N_READS / count_mapped_reads(bam_path)
+    except (ZeroDivisionError, pysam.utils.SamtoolsError) as e:
+        logger.error('Failed to read bam file: %s' % e)
+        sys.exit(1)
+    parts = split_bam(bam_path, n_parts=4 * cpus)
+    # spare cpus are used by htslib to decompress the bam file
+    threads = min(4, max(1, (os.cpu_count() or 1) // cpus))
+    results = Parallel(n_jobs=cpus)(
+        delayed(analyze_bam)(bam_path, part, threads, random_fraction)
+        for part in parts)
+
+    insert_size_dist = Counter()
+    qualities_forward = []
+    qualities_reverse = []
+    for result in results:
+        insert_size_dist.update(result[0])
+        qualities_forward.extend(result[1])
+        qualities_reverse.extend(result[2])
+    subst_matrix_f = sum(result[3] for result in results)
+    subst_matrix_r = sum(result[4] for result in results)
+    indel_matrix_f = sum(result[5] for result in results)
+    indel_matrix_r = sum(result[6] for result in results)
 
     logger.info('Calculating insert size distribution')
-    # insert_size = int(np.mean(insert_size_dist))
     hist_insert_size = modeller.insert_size(insert_size_dist)
 
     logger.info('Calculating mean and base quality distribution')
@@ -205,25 +391,24 @@ def to_model(bam_path, output):
 
     # now we can resize the substitution and indel matrices before
     # doing operations on them
-    subst_matrix_f.resize([read_length, 16], refcheck=False)
-    subst_matrix_r.resize([read_length, 16], refcheck=False)
-    indel_matrix_f.resize([read_length, 9], refcheck=False)
-    indel_matrix_r.resize([read_length, 9], refcheck=False)
+    subst_matrix_f.resize([read_length, 4, 4], refcheck=False)
+    subst_matrix_r.resize([read_length, 4, 4], refcheck=False)
+    indel_matrix_f.resize([read_length, 4, 2], refcheck=False)
+    indel_matrix_r.resize([read_length, 4, 2], refcheck=False)
 
     logger.info('Calculating substitution rate')
     subst_f = modeller.subst_matrix_to_choices(subst_matrix_f, read_length)
     subst_r = modeller.subst_matrix_to_choices(subst_matrix_r, read_length)
 
     logger.info('Calculating indel rate')
-    # update the base count in indel matrices
-    for position in range(read_length):
-        indel_matrix_f[position][0] = sum(subst_matrix_f[position][::4])
-        indel_matrix_r[position][0] = sum(subst_matrix_r[position][::4])
+    # the base count of each position is its number of matches
+    base_counts_f = np.trace(subst_matrix_f, axis1=1, axis2=2)
+    base_counts_r = np.trace(subst_matrix_r, axis1=1, axis2=2)
 
     ins_f, del_f = modeller.indel_matrix_to_choices(
-        indel_matrix_f, read_length)
+        indel_matrix_f, base_counts_f, read_length)
     ins_r, del_r = modeller.indel_matrix_to_choices(
-        indel_matrix_r, read_length)
+        indel_matrix_r, base_counts_r, read_length)
 
     write_to_file(
         'kde',
@@ -1,32 +1,55 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from iss import util
-from scipy import stats
 from joblib import Parallel, delayed
 
 import logging
 import numpy as np
 
+# nucleotide codes used to index the substitution and indel matrices. Upper
+# case bases are coded 0 to 3 (A, T, C, G), lower case bases (mismatches in
+# the reference sequence returned by pysam) 4 to 7. Any other character is
+# coded 8. The index of a nucleotide in the matrices is its code % 4
+BASE_CODES = np.full(256, 8, dtype=np.uint8)
+BASE_CODES[np.frombuffer(b'ATCGatcg', dtype=np.uint8)] = np.arange(8)
+
+# True for the (reference, query) pairs of nucleotide codes that can be
+# dispatched in the substitution matrix: matches (upper case reference base
+# identical to the query base) and substitutions (lower case reference base
+# different from the query base)
+SUBST_DISPATCH = np.zeros((9, 9), dtype=bool)
+SUBST_DISPATCH[:4, :4] = np.eye(4, dtype=bool)
+SUBST_DISPATCH[4:8, :4] = ~np.eye(4, dtype=bool)
+
 
 def insert_size(insert_size_distribution):
     """Calculate cumulative distribution function from the raw insert size
     distributin. Uses 1D kernel density estimation.
 
     Args:
-        insert_size_distribution (list): list of insert sizes from aligned
-        read pairs
+        insert_size_distribution (dict): count of each insert size from
+            aligned read pairs
 
     Returns:
         1darray: a cumulative density function
     """
-    kde = stats.gaussian_kde(
-        insert_size_distribution,
-        bw_method=0.2 / np.std(insert_size_distribution, ddof=1))
-    x_grid = np.linspace(
-        min(insert_size_distribution),
-        max(insert_size_distribution), 1000)
-    kde = kde.evaluate(x_grid)
+    sizes = np.array(sorted(insert_size_distribution))
+    x_grid = np.linspace(sizes[0], sizes[-1], 1000)
+
+    # count of each insert size, from the smallest to the largest
+    counts = np.zeros(sizes[-1] - sizes[0] + 7)
+    counts[sizes - sizes[0] + 3] = [
+        insert_size_distribution[size] for size in sizes]
+    # a gaussian kde with a bandwidth factor of 0.2 / np.std uses a kernel of
+    # standard deviation 0.2: only the insert sizes within 3 of a point of
+    # the grid contribute to its density
+    x_offsets = x_grid - sizes[0]
+    nearest = np.floor(x_offsets).astype(int)
+    kde = np.zeros(len(x_grid))
+    for offset in range(-2, 4):
+        neighbours = nearest + offset
+        kde += counts[neighbours + 3] * np.exp(
+            -(x_offsets - neighbours) ** 2 / (2 * 0.2 ** 2))
     cdf = np.cumsum(kde)
     cdf = cdf / cdf[-1]
     return cdf
@@ -37,37 +60,47 @@ def divide_qualities_into_bins(qualities, n_bins=4):
     quality of the sequence they come from
 
     Args:
-        qualities (list): raw count of all the phred scores and mean sequence
-            quality
+        qualities (list): list of tuples containing the phred scores of a
+            read and its mean sequence quality
         n_bins (int): number of bins to create (default: 4)
 
     Returns:
-        list: a list of lists containing the binned quality scores
+        list: a list of 2d arrays (reads * positions) containing the binned
+            quality scores. The reads of a bin are truncated to the length of
+            the shortest one
     """
     logger = logging.getLogger(__name__)
     logger.debug('Dividing qualities into mean clusters')
-    bin_lists = [[] for _ in range(n_bins)]  # create list of `n_bins` list
     ranges = np.split(np.array(range(40)), n_bins)
-    for quality in qualities:
-        mean = int(quality[0][1])  # mean is at 1 and same regardless of b pos
-        which_array = 0
-        for array in ranges:
-            if mean in array:
-                read = np.fromiter((q[0] for q in quality), dtype=np.float)
-                bin_lists[which_array].append(read)
-            which_array += 1
-    return bin_lists
-
-
-def quality_bins_to_histogram(bin_lists):
+    means = np.fromiter(
+        (int(mean) for _, mean in qualities), dtype=int, count=len(qualities))
+    which_arrays = np.digitize(means, [array[0] for array in ranges[1:]])
+    which_arrays[(means < 0) | (means >= 40)] = -1  # mean out of the ranges
+
+    bin_arrays = []
+    for which_array in range(n_bins):
+        reads = np.flatnonzero(which_arrays == which_array)
+        if len(reads) == 0:
+            bin_arrays.append(np.empty((0, 0), dtype=np.uint8))
+            continue
+        read_length = min(len(qualities[read][0]) for read in reads)
+        # fill a preallocated matrix rather than stacking a list of arrays
+        quality_bin = np.empty((len(reads), read_length), dtype=np.uint8)
+        for row, read in enumerate(reads):
+            quality_bin[row] = qualities[read][0][:read_length]
+        bin_arrays.append(quality_bin)
+    return bin_arrays
+
+
+def quality_bins_to_histogram(bin_arrays):
     """Wrapper function to generate cdfs for each quality bins
 
     Generate cumulative distribution functions for a number of mean quality
     bins
 
     Args:
-        bins_lists (list): list of list containing raw count of all phred
-        scores
+        bin_arrays (list): list of 2d arrays (reads * positions) containing
+            phred scores
 
     Returns:
         list: a list of lists containg cumulative density functions
@@ -75,14 +108,11 @@ def quality_bins_to_histogram(bin_lists):
     logger = logging.getLogger(__name__)
     cdf_bins = []
     i = 0
-    for qual_bin in bin_lists:
+    for qual_bin in bin_arrays:
         if len(qual_bin) > 1:
-            logger.debug('Transposing matrix for mean cluster #%s' % i)
-            # quals = np.asarray(qual_bin).T  # seems to make clunkier models
-            quals = [q for q in zip(*qual_bin)]
             logger.debug(
                 'Modelling quality distribution for mean cluster #%s' % i)
-            cdfs_list = raw_qualities_to_histogram(quals)
+            cdfs_list = raw_qualities_to_histogram(qual_bin.T)
             cdf_bins.append(cdfs_list)
         else:
             logger.debug('Mean quality bin #%s of length < 1. Skipping' % i)
@@ -98,93 +128,95 @@ def raw_qualities_to_histogram(qualities):
     Generate cumulative distribution functions
 
     Args:
-        qualities (list): raw count of all phred scores
+        qualities (list): raw count of all phred scores, one row per position
+            in the read (can be a 2d array)
 
     Returns:
         list: list of cumulative distribution functions. One cdf per base. The
             list has the size of the read length
     """
-    logger = logging.getLogger(__name__)
+    # a gaussian kde with a bandwidth factor of 0.2 / np.std(q) uses a kernel
+    # of standard deviation 0.2. The phred scores being integers, the kde on
+    # range(41) is the histogram of the scores convolved with that kernel
+    offsets = np.arange(-40, 41)
+    kernel = np.exp(-offsets ** 2 / (2 * 0.2 ** 2))
 
-    # moved this in quality_bins_to_histogram to try parallelization
-    # quals = util.split_list([i for i in zip(*qualities)], n_parts=cpus)
     cdfs_list = []
     for q in qualities:
-        numpy_log_handler = np.seterrcall(util.nplog)
-        with np.errstate(under='ignore', divide='call'):
-            try:
-                kde = stats.gaussian_kde(q, bw_method=0.2 / np.std(q, ddof=1))
-            except np.linalg.linalg.LinAlgError as e:
-                # if np.std of array is 0, we modify the array slightly to be
-                # able to divide by ~ np.std
-                # this will print a FloatingPointError in DEBUG mode
-                # logger.debug('np.std of quality array is zero: %s' % e)
-                q = list(q)
-                q[-1] += 1
-                kde = stats.gaussian_kde(q, bw_method=0.2 / np.std(q, ddof=1))
-            kde = kde.evaluate(range(41))
+        # the rows of a quality bin are counted as they are, without a copy
+        counts = np.bincount(q, minlength=41)
+        if np.count_nonzero(counts) == 1:
+            # np.std is zero for a constant position and the kde bandwidth
+            # cannot be computed. We modify one of the scores slightly
+            score = np.argmax(counts)
+            counts = np.append(counts, 0)
+            counts[score] -= 1
+            counts[score + 1] += 1
+        kde = np.convolve(counts, kernel)[40:81]
         cdf = np.cumsum(kde)
         cdf = cdf / cdf[-1]
         cdfs_list.append(cdf)
     return cdfs_list
 
 
-def dispatch_subst(base, read, read_has_indels):
-    """Return the x and y position of a substitution to be inserted in the
-    substitution matrix.
+def dispatch_read_subst(read):
+    """Return the x and y positions of all the substitutions of a read to be
+    inserted in the substitution matrix.
 
-    The substitution matrix is a 2D array of size 301 * 16
+    The substitution matrix is a 3D array of size 301 * 4 * 4
     The x axis (301) corresponds to the position in the read, while
-    the y axis (16) represents the match or substitution (see the dispatch
-    dict in the function). Positions 0, 4, 8 and 12 are matches, other
-    positions are substitutions
+    the y and z axes (4) represent the reference and read nucleotides, in
+    the A, T, C, G order. The diagonal of y and z holds the matches
 
     The size of x axis is 301 because we haven't calculated the read length yet
 
+    The whole alignment of the read is dispatched at once using the
+    BASE_CODES and SUBST_DISPATCH lookup tables. Bases that cannot be
+    dispatched (ambiguous nucleotides) flag the read for indel treatment
+
     Args:
-        base (tuple): one base from an aligmnent object. According to the
-            pysam documentation: an alignment is a list of tuples: aligned read
-            (query) and reference positions. the parameter with_seq adds the
-            ref sequence as the 3rd element of the tuples.
-            substitutions are lower-case.
-        read (read): a read object, from which the alignment comes from
-        read_has_indels (bool): a boolean flag to keep track if the read has
-            an indel or not
+        read (read): an aligned read object
 
     Returns:
-        tuple: x and y position for incrementing the substitution matrix and a
-        third element: True if an indel has been detected, False otherwise
+        tuple: an array of x positions and a tuple of arrays of (y, z)
+        positions for incrementing the substitution matrix, and a third
+        element: True if an indel has been detected, False otherwise
     """
-    dispatch_dict = {
-        'AA': 0,
-        'aT': 1,
-        'aG': 2,
-        'aC': 3,
-        'TT': 4,
-        'tA': 5,
-        'tG': 6,
-        'tC': 7,
-        'CC': 8,
-        'cA': 9,
-        'cT': 10,
-        'cG': 11,
-        'GG': 12,
-        'gA': 13,
-        'gT': 14,
-        'gC': 15
-    }
-
-    query_pos = base[0]
-    query_base = read.seq[query_pos]
-    ref_base = base[2]
-    dispatch_key = ref_base + query_base
-    if dispatch_key not in dispatch_dict:
-        # flag reads that have one or more indels
-        read_has_indels = True  # flag the read for later indel treatment
-        substitution = None  # flag this base to skip substitution treatment
-    else:
-        substitution = dispatch_dict[dispatch_key]
-    return (query_pos, substitution, read_has_indels)
+    # the reference sequence (from the MD tag) is used instead of the aligned
+    # pairs of the read, which would create a python tuple for every base
+    query_codes = BASE_CODES[
+        np.frombuffer(read.query_sequence.encode('ascii'), dtype=np.uint8)]
+    ref_codes = BASE_CODES[np.frombuffer(
+        read.get_reference_sequence().encode('ascii'), dtype=np.uint8)]
+
+    # walk the cigar to find the aligned blocks in both sequences
+    query_blocks = []
+    ref_blocks = []
+    query_offset = 0
+    ref_offset = 0
+    for (cigar_type, cigar_length) in read.cigartuples:
+        if cigar_type in (0, 7, 8):  # match, sequence match or mismatch
+            query_blocks.append(
+                np.arange(query_offset, query_offset + cigar_length))
+            ref_blocks.append(ref_codes[ref_offset:ref_offset + cigar_length])
+            query_offset += cigar_length
+            ref_offset += cigar_length
+        elif cigar_type in (1, 4):  # insertion or soft clip
+            query_offset += cigar_length
+        elif cigar_type == 2:  # deletion
+            ref_offset += cigar_length
+    if not query_blocks:
+        no_base = np.empty(0, dtype=np.uint8)
+        return (np.empty(0, dtype=np.intp), (no_base, no_base), False)
+    query_pos = np.concatenate(query_blocks)
+    ref_codes = np.concatenate(ref_blocks)
+    query_codes = query_codes[query_pos]
+
+    # flag reads that have one or more indels
+    dispatched = SUBST_DISPATCH[ref_codes, query_codes]
+    read_has_indels = not dispatched.all()
+    substitutions = (ref_codes[dispatched] % 4, query_codes[dispatched])
+    return (query_pos[dispatched], substitutions, read_has_indels)
 
 
 def subst_matrix_to_choices(substitution_matrix, read_length):
@@ -195,11 +227,11 @@ def subst_matrix_to_choices(substitution_matrix, read_length):
     probabilties of substitutions
 
     Args:
-        substitution_matrix (np.array): the substitution matrix is a 2D array
-            of size read_length * 16. fhe x axis (read_length) corresponds to
-            the position in the read, while the y axis (16) represents the
-            match or substitution. Positions 0, 4, 8 and 12 are matches, other
-            positions are substitutions
+        substitution_matrix (np.array): the substitution matrix is a 3D array
+            of size read_length * 4 * 4. fhe x axis (read_length) corresponds
+            to the position in the read, while the y and z axes (4) represent
+            the reference and read nucleotides (A, T, C, G). The diagonal of y
+            and z holds the matches
         read_length (int): read length
 
     Returns:
@@ -208,56 +240,28 @@ def subst_matrix_to_choices(substitution_matrix, read_length):
     """
     logger = logging.getLogger(__name__)
 
+    # the substitutions of each nucleotide, in a read_length * 4 * 3 array
+    substitutions = substitution_matrix[:read_length][
+        :, ~np.eye(4, dtype=bool)].reshape(read_length, 4, 3)
+    sums = np.sum(substitutions, axis=2, keepdims=True)
+    # we want to avoid 'na' in the data: if there is no count data for that
+    # nucl at that pos, we assume equal rate of substitution
+    no_data = np.count_nonzero(sums == 0)
+    if no_data:
+        logger.debug(
+            'No substitution data for %s nucleotide(s). Assuming equal rates'
+            % no_data)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        probabilities = np.where(sums == 0, 1/3, substitutions / sums)
+
     nucl_choices_list = []
-    for pos in range(read_length):
-        sums = {
-            'A': np.sum(substitution_matrix[pos][1:4]),
-            'T': np.sum(substitution_matrix[pos][5:8]),
-            'C': np.sum(substitution_matrix[pos][9:12]),
-            'G': np.sum(substitution_matrix[pos][13:])
+    for A, T, C, G in probabilities.tolist():
+        nucl_choices = {
+            'A': (['T', 'C', 'G'], A),
+            'T': (['A', 'C', 'G'], T),
+            'C': (['A', 'T', 'G'], C),
+            'G': (['A', 'T', 'C'], G)
         }
-        # we want to avoid 'na' in the data so we raise FloatingPointError
-        # if we try to divide by 0 (no count data for that nucl at that pos)
-        # we assume equal rate of substitution
-        with np.errstate(all='raise'):
-            nucl_choices = {}
-            try:
-                A = (
-                    ['T', 'C', 'G'],
-                    [count / sums['A'] for
-                        count in substitution_matrix[pos][1:4]])
-            except FloatingPointError as e:
-                logger.debug(e, exc_info=True)
-                A = (['T', 'C', 'G'], [1/3, 1/3, 1/3])
-            try:
-                T = (
-                    ['A', 'C', 'G'],
-                    [count / sums['T'] for
-                        count in substitution_matrix[pos][5:8]])
-            except FloatingPointError as e:
-                logger.debug(e, exc_info=True)
-                T = (['A', 'C', 'G'], [1/3, 1/3, 1/3])
-            try:
-                C = (
-                    ['A', 'T', 'G'],
-                    [count / sums['C'] for
-                        count in substitution_matrix[pos][9:12]])
-            except FloatingPointError as e:
-                logger.debug(e, exc_info=True)
-                C = (['A', 'T', 'G'], [1/3, 1/3, 1/3])
-            try:
-                G = (
-                    ['A', 'T', 'C'],
-                    [count / sums['G'] for
-                        count in substitution_matrix[pos][13:]])
-            except FloatingPointError as e:
-                logger.debug(e, exc_info=True)
-                G = (['A', 'T', 'C'], [1/3, 1/3, 1/3])
-
-            nucl_choices['A'] = A
-            nucl_choices['T'] = T
-            nucl_choices['C'] = C
-            nucl_choices['G'] = G
         nucl_choices_list.append(nucl_choices)
     return nucl_choices_list
 
@@ -266,11 +270,10 @@ def dispatch_indels(read):
     """Return the x and y position of a insertion or deletion to be inserted in
     the indel matrix.
 
-    The substitution matrix is a 2D array of size 301 * 9
-    The x axis (301) corresponds to the position in the read, while
-    the y axis (9) represents the match or indel (see the dispatch
-    dict in the function). Positions 0 is match or substitution, other
-    positions in 'N1' are insertions, 'N2 are deletions'
+    The indel matrix is a 3D array of size 301 * 4 * 2
+    The x axis (301) corresponds to the position in the read, the y axis (4)
+    to the inserted or deleted nucleotide (A, T, C, G) and the z axis (2) to
+    the type of indel: 0 for insertions and 1 for deletions
 
     The size of x axis is 301 because we haven't calculated the read length yet
 
@@ -278,59 +281,49 @@ def dispatch_indels(read):
         read (read): an aligned read object
 
     Yields:
-        tuple: a tuple with the x, y position for dispatching the indel in the
-        indel matrix
+        tuple: a tuple with the x position and the (y, z) position for
+        dispatching the indel in the indel matrix
     """
     logger = logging.getLogger(__name__)
 
-    dispatch_indels = {
-        0: 0,
-        'A1': 1,
-        'T1': 2,
-        'C1': 3,
-        'G1': 4,
-        'A2': 5,
-        'T2': 6,
-        'C2': 7,
-        'G2': 8
-    }
+    cigar = read.cigartuples
+    # reads are flagged for indel treatment as soon as one of their bases
+    # cannot be dispatched as a substitution. Stop early if the read has no
+    # insertion or deletion to dispatch
+    if not any(cigar_type in (1, 2) for cigar_type, _ in cigar):
+        return
+
+    # pysam decodes the sequences at each access, we do it once per read.
+    # The deleted bases are read from the reference sequence of the read
+    query_sequence = read.query_sequence
+    if any(cigar_type == 2 for cigar_type, _ in cigar):
+        reference_sequence = read.get_reference_sequence()
 
     position = 0
-    for (cigar_type, cigar_length) in read.cigartuples:
-        if cigar_type == 0:  # match
+    ref_position = 0  # position in the reference sequence of the read
+    for (cigar_type, cigar_length) in cigar:
+        if cigar_type in (0, 7, 8):  # match, sequence match or mismatch
             position += cigar_length
+            ref_position += cigar_length
             continue
         elif cigar_type == 1:  # insertion
-            query_base = read.query_sequence[position]
-            insertion = query_base.upper() + '1'
-            try:
-                indel = dispatch_indels[insertion]
-                dispatch_tuple = (position, indel)
-                position += cigar_length
-            except KeyError as e:  # we avoid ambiguous bases
-                # logger.debug(
-                #     '%s not in dispatch: %s' % (insertion, e), exc_info=True)
-                position += cigar_length
-                continue
+            base_code = int(BASE_CODES[ord(query_sequence[position])])
+            dispatch_tuple = (position, (base_code % 4, 0))
+            position += cigar_length
         elif cigar_type == 2:  # deletion
-            ref_base = read.query_alignment_sequence[position]
-            deletion = ref_base.upper() + '2'
-            try:
-                indel = dispatch_indels[deletion]
-                dispatch_tuple = (position, indel)
-                position -= cigar_length
-            except KeyError as e:  # we avoid ambiguous bases
-                # logger.debug(
-                #     '%s not in dispatch: %s' % (deletion, e), exc_info=True)
-                position -= cigar_length
-                continue
+            base_code = int(BASE_CODES[
+                ord(reference_sequence[ref_position])])
+            dispatch_tuple = (position, (base_code % 4, 1))
+            position -= cigar_length
+            ref_position += cigar_length
         else:
             logger.debug("CIGAR %s. Skipping read." % cigar_type)
             continue
-        yield dispatch_tuple
+        if base_code < 8:  # we avoid ambiguous bases
+            yield dispatch_tuple
 
 
-def indel_matrix_to_choices(indel_matrix, read_length):
+def indel_matrix_to_choices(indel_matrix, base_counts, read_length):
     """Transform an indel matrix into probabilties of indels for
     at every position
 
@@ -338,32 +331,28 @@ def indel_matrix_to_choices(indel_matrix, read_length):
     probabilties of indel
 
     Args:
-        indel_matrix (np.array): the substitution matrix is a 2D array of
-            size read_length * 16. fhe x axis (read_length) corresponds to the
-            position in the read, while the y axis (9) represents the match or
-            indel. Positions 0 is match or substitution, other positions in
-            'N1' are insertions, 'N2 are deletions'
+        indel_matrix (np.array): the indel matrix is a 3D array of size
+            read_length * 4 * 2. fhe x axis (read_length) corresponds to the
+            position in the read, the y axis (4) to the nucleotide (A, T, C,
+            G) and the z axis (2) to insertions (0) and deletions (1)
+        base_counts (np.array): the number of matches at every position
         read_length (int): read length
 
     Returns:
         tuple: tuple containing two lists of dictionaries representing the
         insertion or deletion probabilities for a collection of reads
     """
+    # divide all the indel counts by the base count of their position
+    rates = indel_matrix[:read_length] / \
+        np.reshape(base_counts[:read_length], (read_length, 1, 1))
+
     ins_choices = []
     del_choices = []
-    for pos in range(read_length):
+    for rate in rates.tolist():
         insertions = {
-            'A': indel_matrix[pos][1] / indel_matrix[pos][0],
-            'T': indel_matrix[pos][2] / indel_matrix[pos][0],
-            'C': indel_matrix[pos][3] / indel_matrix[pos][0],
-            'G': indel_matrix[pos][4] / indel_matrix[pos][0]
-        }
+            nucl: nucl_rate[0] for nucl, nucl_rate in zip('ATCG', rate)}
         deletions = {
-            'A': indel_matrix[pos][5] / indel_matrix[pos][0],
-            'T': indel_matrix[pos][6] / indel_matrix[pos][0],
-            'C': indel_matrix[pos][7] / indel_matrix[pos][0],
-            'G': indel_matrix[pos][8] / indel_matrix[pos][0]
-        }
+            nucl: nucl_rate[1] for nucl, nucl_rate in zip('ATCG', rate)}
         ins_choices.append(insertions)
         del_choices.append(deletions)
     return (ins_choices, del_choices)
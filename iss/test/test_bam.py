@@ -4,9 +4,12 @@
 from iss import bam
 
 from nose.tools import raises
+from queue import Queue
 
 import os
 import sys
+import pysam
+import threading
 
 
 @raises(SystemExit)
@@ -17,8 +20,76 @@ def test_read_fail():
         print(read)
 
 
+def test_read_bam_close():
+    bam_file = 'data/contigs.bam'
+    threads = threading.active_count()
+    bam_reader = bam.read_bam(bam_file, random_fraction=1)
+    next(bam_reader)
+    bam_reader.close()
+    assert threading.active_count() == threads
+
+
+@raises(ValueError)
+def test_read_bam_fetch_fail():
+    bam_file = 'data/ecoli.bam'
+    regions = [('not_a_contig', 0, 100)]
+    for read in bam.read_bam(bam_file, regions=regions):
+        print(read)
+
+
+def test_fetch_reads_stop():
+    batches = Queue()
+    stop = threading.Event()
+    stop.set()
+    bam_file = pysam.AlignmentFile('data/ecoli.bam', 'rb')
+    bam.fetch_reads(bam_file, None, 1, 10, batches, stop)
+    assert batches.get() is None
+    assert batches.empty()
+    assert not bam_file.is_open
+
+
 def test_to_model():
     bam_file = 'data/ecoli.bam'
     output = 'data/test_bam'
     bam.to_model(bam_file, output)
     os.remove(output + '.npz')
+
+
+@raises(SystemExit)
+def test_to_model_no_cpus():
+    bam_file = 'data/ecoli.bam'
+    output = 'data/test_bam'
+    bam.to_model(bam_file, output, cpus=0)
+
+
+def test_analyze_bam():
+    bam_file = 'data/ecoli.bam'
+    (insert_size_dist, qualities_forward, qualities_reverse,
+     subst_matrix_f, subst_matrix_r,
+     indel_matrix_f, indel_matrix_r) = bam.analyze_bam(bam_file)
+    assert sum(insert_size_dist.values()) == 20
+    assert len(qualities_forward) == 10
+    assert len(qualities_reverse) == 10
+    assert subst_matrix_r.sum() == 200
+
+
+def test_split_bam():
+    bam_file = 'data/ecoli.bam'
+    parts = bam.split_bam(bam_file, n_parts=3)
+    assert parts == [
+        [('NC_002695.1', 0, 444)],
+        [('NC_002695.1', 444, 888)],
+        [('NC_002695.1', 888, 1330)]]
+
+
+def test_split_bam_many_contigs():
+    bam_file = 'data/contigs.bam'
+    parts = bam.split_bam(bam_file, n_parts=8)
+    assert len(parts) == 8
+    regions = [region for part in parts for region in part]
+    assert len(set(contig for contig, _, _ in regions)) == 200
+    assert sum(stop - start for _, start, stop in regions) == 200 * 500
+    reads = [
+        read for part in parts
+        for read in bam.read_bam(bam_file, regions=part, random_fraction=1)]
+    assert len(reads) == 600
@@ -9,6 +9,7 @@ from iss import modeller
 from nose.tools import assert_almost_equals
 
 import sys
+import pysam
 import numpy as np
 
 
@@ -26,8 +27,42 @@ def test_kde_qualities():
     assert len(cdf_list) == 5
 
 
+def test_kde_qualities_high_scores():
+    quality_distribution = [
+        [30, 31, 45],
+        [30, 30, 30],
+        [20, 21, 22]]
+    cdf_list = modeller.raw_qualities_to_histogram(quality_distribution)
+    assert len(cdf_list) == 3
+    assert cdf_list[1][3] == 0.0
+    assert_almost_equals(cdf_list[0][30], 0.5)
+    assert cdf_list[2][-1] == 1
+
+
+def test_kde_qualities_constant_high_score():
+    quality_distribution = [
+        [41, 41],
+        [40, 40]]
+    cdf_list = modeller.raw_qualities_to_histogram(quality_distribution)
+    assert len(cdf_list) == 2
+    assert_almost_equals(cdf_list[0][39], 0.0)
+    assert cdf_list[0][-1] == 1
+    assert cdf_list[1][-1] == 1
+
+
+def test_divide_qualities_into_bins():
+    qualities = [
+        (np.array([35, 36, 37], dtype=np.uint8), 36.0),
+        (np.array([5, 6], dtype=np.uint8), 5.5),
+        (np.array([30, 31], dtype=np.uint8), 30.5),
+        (np.array([40, 41], dtype=np.uint8), 40.5)]
+    quality_bins = modeller.divide_qualities_into_bins(qualities)
+    assert [len(quality_bin) for quality_bin in quality_bins] == [1, 0, 0, 2]
+    assert quality_bins[3].tolist() == [[35, 36], [30, 31]]
+
+
 def test_substitutions():
-    subst_matrix = np.zeros([20, 16])
+    subst_matrix = np.zeros([20, 4, 4])
     bam_file = 'data/substitutions_test.bam'
     bam_reader = bam.read_bam(bam_file)
     if sys.version_info > (3,):
@@ -38,20 +73,35 @@ def test_substitutions():
         for _ in range(2):
             bam_reader.next()
         read = bam_reader.next()  # read_1_2
-    alignment = read.get_aligned_pairs(matches_only=True, with_seq=True)
-    read_has_indels = False
-    for base in alignment:
-        pos, subst, read_has_indels = modeller.dispatch_subst(
-            base, read, read_has_indels)
-        subst_matrix[pos, subst] += 1
+    pos, subst, read_has_indels = modeller.dispatch_read_subst(read)
+    np.add.at(subst_matrix, (pos,) + subst, 1)
     choices = modeller.subst_matrix_to_choices(subst_matrix, 20)
     assert read_has_indels is False
-    assert subst_matrix[0][1] == 1
+    assert subst_matrix[0][0][1] == 1
     assert choices[0]['A'] == (['T', 'C', 'G'], [1.0, 0.0, 0.0])
 
 
+def test_read_substitutions():
+    subst_matrix = np.zeros([20, 4, 4])
+    bam_file = 'data/substitutions_test.bam'
+    for read in bam.read_bam(bam_file):
+        pos, subst, read_has_indels = modeller.dispatch_read_subst(read)
+        np.add.at(subst_matrix, (pos,) + subst, 1)
+        assert read_has_indels is False
+    # read_1_2: A -> T at 0, read_2_1: C -> T at 18, read_5_2: G -> A at 19
+    substitutions = subst_matrix.copy()
+    substitutions[:, np.arange(4), np.arange(4)] = 0
+    expected = np.zeros([20, 4, 4])
+    expected[0][0][1] = 1
+    expected[18][2][1] = 1
+    expected[19][3][0] = 1
+    assert np.array_equal(substitutions, expected)
+    # 10 reads of 20 bases, minus the inserted base of read_4_1
+    assert np.trace(subst_matrix, axis1=1, axis2=2).sum() == 196
+
+
 def test_indels():
-    indel_matrix = np.zeros([20, 9])
+    indel_matrix = np.zeros([20, 4, 2])
     bam_file = 'data/substitutions_test.bam'
     bam_reader = bam.read_bam(bam_file)
     if sys.version_info > (3,):
@@ -63,10 +113,27 @@ def test_indels():
             bam_reader.next()
         read = bam_reader.next()  # read_4_1
     for pos, indel in modeller.dispatch_indels(read):
-        indel_matrix[pos, indel] += 1
-    for position in range(20):
-        indel_matrix[position][0] = 5
+        indel_matrix[pos][indel] += 1
+    base_counts = np.full(20, 5)
     insertion, deletion = modeller.indel_matrix_to_choices(
-        indel_matrix, 20)
+        indel_matrix, base_counts, 20)
     assert round(insertion[6]['T'], 2) == 0.2
-    assert indel_matrix[6][2] == 1
+    assert indel_matrix[6][1][0] == 1
+
+
+def test_deletions():
+    read = pysam.AlignedSegment()
+    read.query_sequence = 'AAAAACCCCC'
+    read.cigartuples = [(0, 5), (2, 2), (0, 5)]
+    read.set_tag('MD', '5^GT5')
+    assert list(modeller.dispatch_indels(read)) == [(5, (3, 1))]  # G deleted
+
+
+def test_indels_sequence_match():
+    read = pysam.AlignedSegment()
+    read.query_sequence = 'AAAAATCCCCCC'
+    read.cigartuples = [(7, 4), (8, 1), (1, 1), (2, 2), (7, 6)]
+    read.set_tag('MD', '4C0^GT6')
+    assert list(modeller.dispatch_indels(read)) == [
+        (5, (1, 0)),  # T inserted after the = and X blocks
+        (6, (3, 1))]  # G deleted